@@ -1,31 +1,69 @@
 import streamlit as st
+from streamlit.runtime.scriptrunner import RerunException, StopException
 import openai
-import json
-from datetime import datetime
+import httpx
+import orjson
+from datetime import datetime, timedelta
 import pandas as pd
 import logging
+import atexit
+import queue
+from logging.handlers import QueueHandler, QueueListener
 import time
 import os
+import functools
+import hashlib
+import threading
+from collections import OrderedDict
+import sqlite3
+import uuid
+from contextlib import closing
 from dotenv import load_dotenv
+from streaming import (
+    IMPACT_HEADING,
+    RISK_HEADING,
+    ReasonerStream,
+    format_reasoning_as_quote,
+    split_analysis_sections,
+)
 
 # 加载环境变量
 load_dotenv()
 
-# 设置日志系统
-log_dir = "logs"
-if not os.path.exists(log_dir):
-    os.makedirs(log_dir)
-
-log_file = os.path.join(log_dir, f"stock_analysis_{datetime.now().strftime('%Y%m%d')}.log")
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(message)s',
-    handlers=[
+# 设置日志系统：日志目录、文件与处理器只在进程内初始化一次，避免每次重新运行脚本都
+# 检查目录并新建 FileHandler 泄漏文件句柄；文件与控制台写入由 QueueListener 在后台线程完成
+@st.cache_resource(show_spinner=False)
+def _setup_logging():
+    log_dir = "logs"
+    os.makedirs(log_dir, exist_ok=True)
+    log_file = os.path.join(log_dir, f"stock_analysis_{datetime.now().strftime('%Y%m%d')}.log")
+
+    logger = logging.getLogger('stock_analysis')
+    logger.setLevel(logging.INFO)
+    # 缓存被清除后会重新初始化，先移除上一次的 QueueHandler 并停止其监听线程、关闭文件
+    for handler in logger.handlers[:]:
+        logger.removeHandler(handler)
+        listener = getattr(handler, "listener", None)
+        if listener is not None:
+            atexit.unregister(listener.stop)
+            listener.stop()
+            for listener_handler in listener.handlers:
+                listener_handler.close()
+
+    log_queue = queue.Queue(-1)
+    listener = QueueListener(
+        log_queue,
         logging.FileHandler(log_file, encoding='utf-8'),
         logging.StreamHandler()
-    ]
-)
-logger = logging.getLogger('stock_analysis')
+    )
+    listener.start()
+    atexit.register(listener.stop)
+    queue_handler = QueueHandler(log_queue)
+    queue_handler.listener = listener
+    logger.addHandler(queue_handler)
+    return logger
+
+logger = _setup_logging()
 
 # 设置页面配置
 st.set_page_config(page_title="A股新闻分析助手", layout="wide")
@@ -37,18 +75,45 @@ if "messages" not in st.session_state:
 if "is_first_message" not in st.session_state:
     st.session_state.is_first_message = True
 
-if "history" not in st.session_state:
-    st.session_state.history = []
-
-if "should_stop" not in st.session_state:
-    st.session_state.should_stop = False
-
-# DeepSeek API 配置
-DEEPSEEK_API_KEY = st.secrets.get("DEEPSEEK_API_KEY")
-client = openai.OpenAI(
-    api_key=DEEPSEEK_API_KEY,
-    base_url="https://api.deepseek.com"
-)
+if "session_id" not in st.session_state:
+    st.session_state.session_id = uuid.uuid4().hex
+
+if "api_messages" not in st.session_state:
+    st.session_state.api_messages = []
+
+# 停止生成标记。停止按钮触发整页重新运行时，新的脚本线程会立即启动（runner.fastReruns），
+# 其回调设置该事件时原来的生成仍在读取流式响应，逐块检查即可不再读取后续数据；
+# 中断生成本身依靠 Streamlit 在原运行下一次 st 调用时抛出的 StopException。
+# 关闭 fastReruns 时回调要等原运行被中断后才执行，该事件不会在生成过程中被设置
+if "stop_event" not in st.session_state:
+    st.session_state.stop_event = threading.Event()
+
+# 生成过程中持有，停止生成时用于等待被中断的生成保存已输出的部分
+if "generation_lock" not in st.session_state:
+    st.session_state.generation_lock = threading.Lock()
+
+# DeepSeek API 配置，客户端在各次重新运行间复用以保留连接池；
+# 启用 HTTP/2 与长连接，连续的请求复用同一 TCP/TLS 连接
+@st.cache_resource(show_spinner=False)
+def get_client():
+    http_client = httpx.Client(
+        http2=True,
+        timeout=httpx.Timeout(60.0, connect=5.0),
+        limits=httpx.Limits(max_keepalive_connections=8, keepalive_expiry=60)
+    )
+    return openai.OpenAI(
+        api_key=st.secrets.get("DEEPSEEK_API_KEY"),
+        base_url="https://api.deepseek.com",
+        http_client=http_client
+    )
+
+client = get_client()
+
+# 后续对话发送给 API 的最近消息条数（不含固定保留的系统提示词与新闻消息）
+MAX_WINDOW = 12
+
+# 点击停止生成后等待被中断的生成保存部分输出的最长时间（秒）
+STOP_WAIT_TIMEOUT = 2.0
 
 # 内置提示词
 prompt_a = """
@@ -66,50 +131,97 @@ prompt_a = """
 - 受损行业
 
 注意，如果新闻对A股影响不明显，请直接说明"影响有限"。
+"""
 
+# 新闻内容单独放在用户消息中，保证系统提示词前缀在每次请求中完全一致以命中前缀缓存
+news_template = """
 新闻内容：
 
 {input}
 """
 
+# 同一条新闻只格式化一次，重复提交时得到逐字节相同的用户消息
+@functools.lru_cache(maxsize=32)
+def format_news_message(news):
+    return news_template.format(input=news)
+
 prompt_b = """
-你是一位资深的风险分析师。现在需要你基于刚才的新闻对前期分析的利好行业和公司进行风险提示。
+完成上述分析后，请以资深风险分析师的身份，基于新闻对前面分析的利好行业和公司进行风险提示。
 
 请从行业、公司及时间（短期和中长期）维度进行风险分析：
 
 注意，保持客观专业，避免过度悲观；风险分析要有针对性，避免泛泛而谈；如果认为某项风险特别重要，请用"⚠️"标注
 
-如果前期分析显示"影响有限"，则直接回复"无需进行风险分析"。
+如果前面的分析结论为"影响有限"，则风险提示部分直接回复"无需进行风险分析"。
+"""
+
+output_format = f"""
+分析新闻时，请严格按以下格式输出，两个标题各单独占一行且只出现一次：
+
+{IMPACT_HEADING}
+（利好与利空分析）
+
+{RISK_HEADING}
+（风险提示）
 """
 
+# 新闻分析的完整系统提示词，同时作为后续对话请求的固定前缀
+analysis_prompt = prompt_a + prompt_b + output_format
+
+# 日志截断长度
+LOG_TRUNCATE_LENGTH = 500
+
+# 截断过长的日志字段
+def truncate_log_text(text):
+    if text and len(text) > LOG_TRUNCATE_LENGTH:
+        return text[:LOG_TRUNCATE_LENGTH] + "..."
+    return text
+
 # 结构化日志记录函数
-def log_generation(input_context: str, output: str, reasoning: str, model: str, duration: float, status: str, step: str):
-    """记录生成过程的日志"""
+def log_generation(input_context: str, output: str, reasoning: str, model: str, duration: float, status: str, step: str, usage=None):
+    """记录生成过程的日志，usage 为流式响应最后一块返回的 token 统计"""
+    # QueueHandler 在调用线程上格式化消息，未启用 INFO 级别时直接跳过截断与序列化
+    if not logger.isEnabledFor(logging.INFO):
+        return
     try:
+        prompt_tokens = completion_tokens = cached_prompt_tokens = None
+        if usage is not None:
+            prompt_tokens = usage.prompt_tokens
+            completion_tokens = usage.completion_tokens
+            # DeepSeek 返回 prompt_cache_hit_tokens，OpenAI 兼容字段为 prompt_tokens_details.cached_tokens
+            cached_prompt_tokens = getattr(usage, "prompt_cache_hit_tokens", None)
+            if cached_prompt_tokens is None:
+                cached_prompt_tokens = getattr(getattr(usage, "prompt_tokens_details", None), "cached_tokens", None)
+
         log_data = {
             "timestamp": datetime.now().isoformat(),
             "step": step,
-            "input": input_context[:500] + "..." if len(input_context) > 500 else input_context,
-            "output": output[:500] + "..." if len(output) > 500 else output,
-            "reasoning": reasoning[:500] + "..." if reasoning and len(reasoning) > 500 else reasoning,
+            "input": truncate_log_text(input_context),
+            "output": truncate_log_text(output),
+            "reasoning": truncate_log_text(reasoning),
             "model_parameters": {
                 "model": model,
             },
             "duration_seconds": duration,
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "cached_prompt_tokens": cached_prompt_tokens,
             "status": status
         }
-        logger.info(json.dumps(log_data, ensure_ascii=False))
+        logger.info(orjson.dumps(log_data).decode())
     except Exception as e:
         logger.error(f"Failed to log generation: {str(e)}")
 
-# 将思维链转换为引用格式的函数
-def format_reasoning_as_quote(reasoning_text):
-    """将思维链转换为Markdown引用格式"""
-    if not reasoning_text:
-        return ""
-    lines = reasoning_text.split('\n')
-    quoted_lines = [f"> {line}" for line in lines]
-    return '\n'.join(quoted_lines)
+# 构建后续对话的请求消息
+def build_request_messages(user_message):
+    """固定保留系统提示词与新闻原文作为可缓存前缀，其余只发送最近 MAX_WINDOW 条消息"""
+    api_messages = st.session_state.api_messages
+    pinned = api_messages[:2]
+    recent = api_messages[2:][-MAX_WINDOW:]
+    # deepseek-reasoner 要求用户与助手消息交替，窗口紧跟新闻消息时不能以用户消息开头
+    if recent and recent[0]["role"] == "user":
+        recent = recent[1:]
+    return pinned + recent + [user_message]
 
 # 创建布局函数
 def create_layout():
@@ -124,160 +236,212 @@ def display_messages(container):
             with st.chat_message(message["role"]):
                 st.markdown(message["content"])
 
+# 新闻分析结果缓存的有效期（秒）与最大条数
+ANALYSIS_CACHE_TTL = 86400
+ANALYSIS_CACHE_MAX_ENTRIES = 256
+
+# 按提示词与新闻内容哈希缓存完整的分析结果，重复提交同一新闻时直接返回
+class AnalysisCache:
+    """进程内共享的 LRU 缓存，值为 (思维链, 利好分析, 风险提示)"""
+
+    def __init__(self, ttl, max_entries):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(news):
+        return hashlib.sha256((analysis_prompt + news).encode("utf-8")).hexdigest()
+
+    def get(self, news):
+        key = self.make_key(news)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            created_at, result = entry
+            if time.time() - created_at > self.ttl:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return result
+
+    def set(self, news, result):
+        key = self.make_key(news)
+        with self._lock:
+            self._entries[key] = (time.time(), result)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+@st.cache_resource(show_spinner=False)
+def get_analysis_cache():
+    return AnalysisCache(ANALYSIS_CACHE_TTL, ANALYSIS_CACHE_MAX_ENTRIES)
+
+# 停止生成时追加在已输出内容之后的提示
+STOPPED_NOTE = "\n\n*（已停止生成）*"
+
+# 流式输出被整页重新运行中断时（例如点击停止生成），关闭请求并保留已生成的部分
+def record_interrupted_response(stream, chat_messages, input_context, start_time, step):
+    """部分内容只写入对话消息，不进入请求消息、缓存与历史记录。
+    中断后再访问 st.session_state 会再次抛出中断异常，因此追加到事先取出的消息列表"""
+    stream.close()
+    content = "".join(stream.content_parts)
+    log_generation(
+        input_context=input_context,
+        output=content,
+        reasoning="".join(stream.reasoning_parts),
+        model="deepseek-reasoner",
+        duration=time.time() - start_time,
+        status="stopped",
+        step=step,
+        usage=stream.usage
+    )
+    if content:
+        chat_messages.append({"role": "assistant", "content": content + STOPPED_NOTE})
+
+# 拼接完整的新闻分析回复，对话消息与日志使用同一格式
+def format_analysis_response(impact_result, risk_result):
+    return f"{IMPACT_HEADING}\n\n{impact_result}\n\n{RISK_HEADING}\n\n{risk_result}"
+
+# 记录完成的新闻分析（对话消息、请求消息与历史记录）
+def record_first_analysis(user_input, reasoning, impact_result, risk_result):
+    complete_response = format_analysis_response(impact_result, risk_result)
+    st.session_state.messages.append({"role": "assistant", "content": complete_response})
+    st.session_state.api_messages.append({"role": "assistant", "content": complete_response})
+
+    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    save_history({
+        "timestamp": timestamp,
+        "news": user_input,
+        "impact_analysis": impact_result,
+        "impact_reasoning": reasoning,
+        "risk_analysis": risk_result,
+        "risk_reasoning": ""
+    })
+
 # 首次消息处理（新闻分析）
 def handle_first_message(user_input, msg_container):
-    st.session_state.should_stop = False
-    st.session_state.messages.append({"role": "user", "content": user_input})
+    stop_event = st.session_state.stop_event
+    stop_event.clear()
+    chat_messages = st.session_state.messages
+    chat_messages.append({"role": "user", "content": user_input})
     
     with msg_container.chat_message("assistant"):
-        st.markdown("### 📊 利好分析")
-        reasoning1_placeholder = st.empty()
+        reasoning_placeholder = st.empty()
         impact_placeholder = st.empty()
+        risk_placeholder = st.empty()
         
-        col1, col2 = st.columns([5,1])
-        with col2:
-            stop_button = st.button("停止生成", key="stop_button")
-            if stop_button:
-                st.session_state.should_stop = True
-                return
+        start_time = time.time()
+        news_message = format_news_message(user_input)
+        st.session_state.api_messages = [
+            {"role": "system", "content": analysis_prompt},
+            {"role": "user", "content": news_message}
+        ]
+
+        analysis_cache = get_analysis_cache()
+        cached_analysis = analysis_cache.get(user_input)
+        if cached_analysis is not None:
+            reasoning, impact_result, risk_result = cached_analysis
+            reasoning_placeholder.markdown(format_reasoning_as_quote(reasoning))
+            impact_placeholder.markdown(f"{IMPACT_HEADING}\n\n{impact_result}")
+            risk_placeholder.markdown(f"{RISK_HEADING}\n\n{risk_result}")
 
-        start_time_impact = time.time()
-        formatted_prompt = prompt_a.format(input=user_input)
-        first_reasoning = ""
-        first_result = ""
+            log_generation(
+                input_context=news_message,
+                output=format_analysis_response(impact_result, risk_result),
+                reasoning=reasoning,
+                model="deepseek-reasoner",
+                duration=time.time() - start_time,
+                status="cache_hit",
+                step="news_analysis"
+            )
+            record_first_analysis(user_input, reasoning, impact_result, risk_result)
+            st.session_state.is_first_message = False
+            return impact_result, risk_result
 
-        first_analysis_stream = client.chat.completions.create(
-            model="deepseek-reasoner",
-            messages=[
-                {"role": "system", "content": "你是一位专业的金融分析师和A股市场专家。"},
-                {"role": "user", "content": formatted_prompt}
-            ],
-            stream=True
+        # 利好分析与风险提示合并为一次调用，只需一次推理过程
+        analysis_stream = ReasonerStream(
+            client.chat.completions.create(
+                model="deepseek-reasoner",
+                messages=st.session_state.api_messages,
+                stream=True,
+                stream_options={"include_usage": True}
+            ),
+            stop_event
         )
+        try:
+            reasoning_placeholder.write_stream(analysis_stream.reasoning())
+            # 正文自带两个小标题，在风险提示标题处切换到下一个占位符
+            impact_placeholder.write_stream(analysis_stream.content(until=RISK_HEADING))
+            risk_placeholder.write_stream(analysis_stream.content())
+        except (RerunException, StopException):
+            record_interrupted_response(analysis_stream, chat_messages, news_message, start_time, "news_analysis")
+            raise
+        # 读取因停止事件提前结束而未触发中断时，同样只保留部分输出，不写入历史记录与缓存
+        if stop_event.is_set():
+            record_interrupted_response(analysis_stream, chat_messages, news_message, start_time, "news_analysis")
+            return "", ""
+
+        reasoning = "".join(analysis_stream.reasoning_parts)
+        impact_result, risk_result = split_analysis_sections("".join(analysis_stream.content_parts))
+        usage = analysis_stream.usage
 
-        for chunk in first_analysis_stream:
-            if st.session_state.should_stop:
-                break
-            if chunk.choices[0].delta.reasoning_content:
-                content = chunk.choices[0].delta.reasoning_content
-                first_reasoning += content
-                reasoning1_placeholder.markdown(format_reasoning_as_quote(first_reasoning))
-            elif chunk.choices[0].delta.content:
-                content = chunk.choices[0].delta.content
-                first_result += content
-                impact_placeholder.markdown(first_result)
-
-        impact_duration = time.time() - start_time_impact
+        duration = time.time() - start_time
         log_generation(
-            input_context=formatted_prompt,
-            output=first_result,
-            reasoning=first_reasoning,
+            input_context=news_message,
+            output=format_analysis_response(impact_result, risk_result),
+            reasoning=reasoning,
             model="deepseek-reasoner",
-            duration=impact_duration,
+            duration=duration,
             status="success",
-            step="impact_analysis"
+            step="news_analysis",
+            usage=usage
         )
 
-        if not st.session_state.should_stop:
-            st.markdown("### ⚠️ 风险提示")
-            reasoning2_placeholder = st.empty()
-            risk_placeholder = st.empty()
-            start_time_risk = time.time()
-            second_reasoning = ""
-            second_result = ""
-
-            second_analysis_stream = client.chat.completions.create(
-                model="deepseek-reasoner",
-                messages=[
-                    {"role": "system", "content": "你是一位资深的风险分析师。"},
-                    {"role": "user", "content": formatted_prompt},
-                    {"role": "assistant", "content": first_result},
-                    {"role": "user", "content": prompt_b}
-                ],
-                stream=True
-            )
-
-            for chunk in second_analysis_stream:
-                if st.session_state.should_stop:
-                    break
-                if chunk.choices[0].delta.reasoning_content:
-                    content = chunk.choices[0].delta.reasoning_content
-                    second_reasoning += content
-                    reasoning2_placeholder.markdown(format_reasoning_as_quote(second_reasoning))
-                elif chunk.choices[0].delta.content:
-                    content = chunk.choices[0].delta.content
-                    second_result += content
-                    risk_placeholder.markdown(second_result)
-
-            risk_duration = time.time() - start_time_risk
-            log_generation(
-                input_context=f"{formatted_prompt}\n\n{first_result}\n\n{prompt_b}",
-                output=second_result,
-                reasoning=second_reasoning,
-                model="deepseek-reasoner",
-                duration=risk_duration,
-                status="success",
-                step="risk_analysis"
-            )
-
-            complete_response = f"### 📊 利好分析\n\n{first_result}\n\n### ⚠️ 风险提示\n\n{second_result}"
-            st.session_state.messages.append({"role": "assistant", "content": complete_response})
-
-            timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-            st.session_state.history.append({
-                "timestamp": timestamp,
-                "news": user_input,
-                "impact_analysis": first_result,
-                "impact_reasoning": first_reasoning,
-                "risk_analysis": second_result,
-                "risk_reasoning": second_reasoning
-            })
+        record_first_analysis(user_input, reasoning, impact_result, risk_result)
+        analysis_cache.set(user_input, (reasoning, impact_result, risk_result))
 
         st.session_state.is_first_message = False
-        return first_result, second_result
+        return impact_result, risk_result
 
 # 后续消息处理（常规对话）
 def handle_regular_message(user_input, msg_container):
-    st.session_state.should_stop = False
-    st.session_state.messages.append({"role": "user", "content": user_input})
+    stop_event = st.session_state.stop_event
+    stop_event.clear()
+    chat_messages = st.session_state.messages
+    chat_messages.append({"role": "user", "content": user_input})
     
-    messages = []
-    for msg in st.session_state.messages[:-1]:
-        messages.append({"role": msg["role"], "content": msg["content"]})
-    messages.append({"role": "user", "content": user_input})
+    # 只在已有请求消息之后追加新的一轮，保持与上次请求的公共前缀逐字节一致
+    user_message = {"role": "user", "content": user_input}
+    messages = build_request_messages(user_message)
 
     with msg_container.chat_message("assistant"):
         reasoning_placeholder = st.empty()
         message_placeholder = st.empty()
         
-        col1, col2 = st.columns([5,1])
-        with col2:
-            stop_button = st.button("停止生成", key="stop_button")
-            if stop_button:
-                st.session_state.should_stop = True
-                return
-
         start_time = time.time()
-        reasoning = ""
-        response = ""
-
-        response_stream = client.chat.completions.create(
-            model="deepseek-reasoner",
-            messages=messages,
-            stream=True
+        response_stream = ReasonerStream(
+            client.chat.completions.create(
+                model="deepseek-reasoner",
+                messages=messages,
+                stream=True,
+                stream_options={"include_usage": True}
+            ),
+            stop_event
         )
-
-        for chunk in response_stream:
-            if st.session_state.should_stop:
-                break
-            if chunk.choices[0].delta.reasoning_content:
-                content = chunk.choices[0].delta.reasoning_content
-                reasoning += content
-                reasoning_placeholder.markdown(format_reasoning_as_quote(reasoning))
-            elif chunk.choices[0].delta.content:
-                content = chunk.choices[0].delta.content
-                response += content
-                message_placeholder.markdown(response)
+        try:
+            reasoning_placeholder.write_stream(response_stream.reasoning())
+            response = message_placeholder.write_stream(response_stream.content())
+        except (RerunException, StopException):
+            record_interrupted_response(response_stream, chat_messages, user_input, start_time, "conversation")
+            raise
+        if stop_event.is_set():
+            record_interrupted_response(response_stream, chat_messages, user_input, start_time, "conversation")
+            return response
+        reasoning = "".join(response_stream.reasoning_parts)
+        usage = response_stream.usage
 
         duration = time.time() - start_time
         log_generation(
@@ -287,29 +451,133 @@ def handle_regular_message(user_input, msg_container):
             model="deepseek-reasoner",
             duration=duration,
             status="success",
-            step="conversation"
+            step="conversation",
+            usage=usage
         )
 
         st.session_state.messages.append({"role": "assistant", "content": response})
+        st.session_state.api_messages.append(user_message)
+        st.session_state.api_messages.append({"role": "assistant", "content": response})
         return response
 
+# 历史记录存储（SQLite），避免在会话内存中保留完整的分析文本
+history_db = os.path.join("data", "history.db")
+
+# 历史记录每页显示条数
+HISTORY_PAGE_SIZE = 10
+
+# 历史记录保留天数；会话刷新后旧记录无法再查看，超期的记录在写入新记录时删除
+HISTORY_RETENTION_DAYS = 7
+
+# 历史记录列表查询缓存的最大条数与有效期（秒）
+HISTORY_LIST_CACHE_MAX_ENTRIES = 256
+HISTORY_LIST_CACHE_TTL = 3600
+
+@st.cache_resource(show_spinner=False)
+def init_history_db():
+    """创建历史记录数据库及表结构，每个进程只执行一次"""
+    os.makedirs(os.path.dirname(history_db), exist_ok=True)
+    with closing(sqlite3.connect(history_db)) as conn, conn:
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS history (
+                id INTEGER PRIMARY KEY,
+                session_id TEXT,
+                ts TEXT,
+                news TEXT,
+                impact TEXT,
+                impact_reasoning TEXT,
+                risk TEXT,
+                risk_reasoning TEXT
+            )
+        """)
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_history_session ON history (session_id, id)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_history_ts ON history (ts)")
+    return history_db
+
+def connect_history_db():
+    return closing(sqlite3.connect(init_history_db()))
+
+def save_history(record):
+    """将一条分析记录写入数据库，并删除超过保留期的记录"""
+    expire_before = (datetime.now() - timedelta(days=HISTORY_RETENTION_DAYS)).strftime("%Y-%m-%d %H:%M:%S")
+    with connect_history_db() as conn, conn:
+        conn.execute("DELETE FROM history WHERE ts < ?", (expire_before,))
+        conn.execute(
+            "INSERT INTO history (session_id, ts, news, impact, impact_reasoning, risk, risk_reasoning) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (
+                st.session_state.session_id,
+                record["timestamp"],
+                record["news"],
+                record["impact_analysis"],
+                record["impact_reasoning"],
+                record["risk_analysis"],
+                record["risk_reasoning"],
+            )
+        )
+
+def count_history(session_id):
+    """返回 (记录数, 最新记录 id)"""
+    with connect_history_db() as conn:
+        return conn.execute("SELECT COUNT(*), MAX(id) FROM history WHERE session_id = ?", (session_id,)).fetchone()
+
+@st.cache_data(max_entries=HISTORY_LIST_CACHE_MAX_ENTRIES, ttl=HISTORY_LIST_CACHE_TTL, show_spinner=False)
+def list_history(session_id, last_id, row_count, page):
+    """查询一页历史记录列表（仅包含新闻摘要）。
+    最新记录 id 只增不减，记录数在 id 不变时只会因过期删除而减少，两者一起作为缓存键的一部分"""
+    with connect_history_db() as conn:
+        return conn.execute(
+            "SELECT id, ts, substr(news, 1, 200), length(news) FROM history "
+            "WHERE session_id = ? ORDER BY id DESC LIMIT ? OFFSET ?",
+            (session_id, HISTORY_PAGE_SIZE, (page - 1) * HISTORY_PAGE_SIZE)
+        ).fetchall()
+
+def load_history(record_id):
+    """按需读取单条记录的完整分析内容"""
+    with connect_history_db() as conn:
+        row = conn.execute(
+            "SELECT impact, impact_reasoning, risk, risk_reasoning FROM history WHERE id = ?",
+            (record_id,)
+        ).fetchone()
+    # 列表读取后记录可能已被其他会话按保留期删除
+    if row is None:
+        return None
+    return {
+        "impact_analysis": row[0],
+        "impact_reasoning": row[1],
+        "risk_analysis": row[2],
+        "risk_reasoning": row[3]
+    }
+
 # 显示历史记录
 def show_history():
     st.subheader("历史分析记录")
-    if not st.session_state.history:
+    session_id = st.session_state.session_id
+    row_count, last_id = count_history(session_id)
+    if not row_count:
         st.info("暂无历史记录")
         return
 
-    for i, record in enumerate(reversed(st.session_state.history)):
-        with st.expander(f"#{i+1} - {record['timestamp']}"):
+    page_count = (row_count + HISTORY_PAGE_SIZE - 1) // HISTORY_PAGE_SIZE
+    page = 1
+    if page_count > 1:
+        page = st.number_input(f"页码（共 {page_count} 页）", min_value=1, max_value=page_count, value=1, step=1, key="history_page")
+    offset = (page - 1) * HISTORY_PAGE_SIZE
+
+    for i, (record_id, timestamp, news_preview, news_length) in enumerate(list_history(session_id, last_id, row_count, page)):
+        with st.expander(f"#{offset+i+1} - {timestamp}"):
             st.markdown("#### 新闻内容")
             try:
-                news_text = record["news"][:200] + "..." if len(record["news"]) > 200 else record["news"]
+                news_text = news_preview + "..." if news_length > 200 else news_preview
                 st.text(news_text)
             except Exception as e:
                 st.text("(新闻内容显示错误)")
 
-            if st.button("查看完整分析", key=f"view_history_{i}"):
+            if st.button("查看完整分析", key=f"view_history_{record_id}"):
+                record = load_history(record_id)
+                if record is None:
+                    st.info("该记录已超过保留期被删除")
+                    continue
                 st.markdown("#### 📊 股市分析")
                 st.markdown(format_reasoning_as_quote(record["impact_reasoning"]))
                 st.markdown(record["impact_analysis"])
@@ -339,40 +607,71 @@ def inject_css():
         </style>
     """, unsafe_allow_html=True)
 
+# 发送按钮回调：取出输入内容并清空输入框（回调在组件创建前执行，可以直接修改其状态）
+def submit_user_input():
+    st.session_state.pending_input = st.session_state.user_input
+    st.session_state.user_input = ""
+
+# 停止生成按钮回调。整页重新运行默认立即启动新的脚本线程（runner.fastReruns），
+# 原来的运行在下一次 st 调用时以 StopException 中断，因此回调执行时生成可能仍在进行
+def stop_generation():
+    st.session_state.stop_event.set()
+    # 等待被中断的生成写入部分输出，本次运行才能显示出来
+    generation_lock = st.session_state.generation_lock
+    if generation_lock.acquire(timeout=STOP_WAIT_TIMEOUT):
+        generation_lock.release()
+
+# 开始新对话按钮回调
+def reset_conversation():
+    st.session_state.messages = []
+    st.session_state.api_messages = []
+    st.session_state.is_first_message = True
+
+# 对话区域，交互时只重新运行该片段，不重新渲染页面其余部分
+@st.fragment
+def chat_fragment():
+    msg_container, input_container = create_layout()
+    display_messages(msg_container)
+
+    with input_container:
+        col1, col2 = st.columns([6,1])
+        with col1:
+            st.text_input("输入新闻或您的问题...", key="user_input")
+        with col2:
+            st.button("发送", key="send_button", on_click=submit_user_input)
+
+        st.button("开始新对话", key="new_conversation", on_click=reset_conversation)
+
+    user_input = st.session_state.pop("pending_input", "")
+    if user_input:
+        is_first_message = st.session_state.is_first_message
+        try:
+            with st.session_state.generation_lock:
+                if is_first_message:
+                    handle_first_message(user_input, msg_container)
+                else:
+                    handle_regular_message(user_input, msg_container)
+        except (RerunException, StopException):
+            # 停止生成或其他组件触发的重新运行会中断处理，需交还给 Streamlit
+            raise
+        except Exception as e:
+            st.error(f"处理失败: {str(e)}")
+        else:
+            # 新闻分析会写入历史记录，需要整页刷新；常规对话只刷新对话区域
+            st.rerun(scope="app" if is_first_message else "fragment")
+
 # 主函数
 def main():
     st.title("A股新闻分析助手")
     st.write("基于 DeepSeek R1 模型的新闻分析工具，帮助您了解新闻可能对 A 股市场的影响。注意，R1模型有较强的幻觉，可能会输出不准确的数据信息，请核实后使用")
 
-    msg_container, input_container = create_layout()
-    
     tab1, tab2 = st.tabs(["对话", "历史记录"])
     
     with tab1:
-        display_messages(msg_container)
-        
-        with input_container:
-            col1, col2 = st.columns([6,1])
-            with col1:
-                user_input = st.text_input("输入新闻或您的问题...", key="user_input")
-            with col2:
-                if st.button("发送", key="send_button"):
-                    if user_input:
-                        try:
-                            if st.session_state.is_first_message:
-                                handle_first_message(user_input, msg_container)
-                            else:
-                                handle_regular_message(user_input, msg_container)
-                            # 添加以下行来清空输入框
-                            st.session_state.user_input = ""
-                            st.experimental_rerun()
-                        except Exception as e:
-                            st.error(f"处理失败: {str(e)}")
-            
-            if st.button("开始新对话", key="new_conversation"):
-                st.session_state.messages = []
-                st.session_state.is_first_message = True
-                st.experimental_rerun()
+        chat_fragment()
+        # 停止按钮放在片段之外：片段内的组件只触发片段重新运行，不会中断正在执行的生成；
+        # 片段外的组件触发整页重新运行，Streamlit 会在下一次 st 调用时中断当前生成
+        st.button("停止生成", key="stop_button", on_click=stop_generation)
     
     with tab2:
         show_history()
@@ -381,6 +680,9 @@ if __name__ == "__main__":
     try:
         inject_css()
         main()
+    except (RerunException, StopException):
+        # Streamlit 通过异常控制重新运行与停止，需交还给 Streamlit 处理
+        raise
     except Exception as e:
         log_generation(
             input_context="应用启动",
@@ -0,0 +1,115 @@
+# 流式响应处理：思维链引用格式转换、deepseek-reasoner 流式响应拆分与分析结果拆分
+import time
+
+# 流式输出时界面刷新的最小间隔（秒），避免每个 token 都重新渲染整段 Markdown
+STREAM_FLUSH_INTERVAL = 0.05
+
+# 新闻分析在一次调用中同时输出利好分析与风险提示，按以下标题拆分
+IMPACT_HEADING = "### 📊 利好分析"
+RISK_HEADING = "### ⚠️ 风险提示"
+
+# 将思维链转换为引用格式的函数
+def format_reasoning_as_quote(reasoning_text):
+    """将思维链转换为Markdown引用格式"""
+    if not reasoning_text:
+        return ""
+    lines = reasoning_text.split('\n')
+    quoted_lines = [f"> {line}" for line in lines]
+    return '\n'.join(quoted_lines)
+
+# 增量转换新到达的思维链片段，避免每次刷新都对完整文本重新分行
+def incremental_quote(delta, at_start):
+    """将思维链片段转换为引用格式，依次拼接后与 format_reasoning_as_quote 的结果一致"""
+    prefix = "> " if at_start else ""
+    return prefix + delta.replace('\n', '\n> ')
+
+# 将 deepseek-reasoner 的流式响应拆分为依次消费的思维链与正文生成器，交给 st.write_stream 渲染
+class ReasonerStream:
+    """每个生成器按 STREAM_FLUSH_INTERVAL 合并小片段后输出；原始文本累积在 reasoning_parts / content_parts"""
+
+    def __init__(self, stream, stop_event):
+        self.reasoning_parts = []
+        self.content_parts = []
+        self.usage = None
+        self._stop_event = stop_event
+        self._stream = stream
+        self._deltas = self._iter_deltas(stream)
+        self._buffer = ""
+
+    def _iter_deltas(self, stream):
+        for chunk in stream:
+            if self._stop_event.is_set():
+                return
+            if chunk.usage:
+                self.usage = chunk.usage
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta
+            if delta.reasoning_content:
+                yield "reasoning", delta.reasoning_content
+            elif delta.content:
+                yield "content", delta.content
+
+    def close(self):
+        """关闭底层 HTTP 响应，中断时不再继续接收服务端生成的 token"""
+        self._deltas.close()
+        self._stream.close()
+
+    def reasoning(self):
+        """输出引用格式的思维链，遇到第一段正文时结束"""
+        batch = []
+        last_flush = time.monotonic()
+        for kind, text in self._deltas:
+            if kind == "content":
+                self.content_parts.append(text)
+                self._buffer += text
+                break
+            batch.append(incremental_quote(text, not self.reasoning_parts))
+            self.reasoning_parts.append(text)
+            if time.monotonic() - last_flush > STREAM_FLUSH_INTERVAL:
+                yield "".join(batch)
+                batch = []
+                last_flush = time.monotonic()
+        if batch:
+            yield "".join(batch)
+
+    def content(self, until=None):
+        """输出正文；指定 until 时在该标记前结束，标记及之后的内容留给下一次调用"""
+        batch = []
+        last_flush = time.monotonic()
+        while True:
+            if until:
+                index = self._buffer.find(until)
+                if index >= 0:
+                    batch.append(self._buffer[:index])
+                    self._buffer = self._buffer[index:]
+                    break
+                # 保留可能是标记开头的末尾部分，等待后续片段
+                safe_length = max(len(self._buffer) - len(until) + 1, 0)
+            else:
+                safe_length = len(self._buffer)
+            batch.append(self._buffer[:safe_length])
+            self._buffer = self._buffer[safe_length:]
+            if time.monotonic() - last_flush > STREAM_FLUSH_INTERVAL:
+                yield "".join(batch)
+                batch = []
+                last_flush = time.monotonic()
+
+            text = next((text for kind, text in self._deltas if kind == "content"), None)
+            if text is None:
+                batch.append(self._buffer)
+                self._buffer = ""
+                break
+            self.content_parts.append(text)
+            self._buffer += text
+        if any(batch):
+            yield "".join(batch)
+
+# 按风险提示标题拆分合并输出的分析内容
+def split_analysis_sections(content):
+    """返回 (利好分析, 风险提示)，未出现风险提示标题时全部视为利好分析"""
+    impact, _, risk = content.partition(RISK_HEADING)
+    impact = impact.strip()
+    if impact.startswith(IMPACT_HEADING):
+        impact = impact[len(IMPACT_HEADING):].lstrip()
+    return impact, risk.strip()
@@ -0,0 +1,93 @@
+import threading
+from types import SimpleNamespace
+
+from streaming import (
+    IMPACT_HEADING,
+    RISK_HEADING,
+    ReasonerStream,
+    format_reasoning_as_quote,
+    incremental_quote,
+    split_analysis_sections,
+)
+
+
+def make_chunk(reasoning=None, content=None):
+    delta = SimpleNamespace(reasoning_content=reasoning, content=content)
+    return SimpleNamespace(choices=[SimpleNamespace(delta=delta)], usage=None)
+
+
+def make_usage_chunk():
+    usage = SimpleNamespace(prompt_tokens=10, completion_tokens=5, prompt_cache_hit_tokens=8)
+    return SimpleNamespace(choices=[], usage=usage)
+
+
+class FakeStream:
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.closed = False
+
+    def __iter__(self):
+        return iter(self.chunks)
+
+    def close(self):
+        self.closed = True
+
+
+def test_incremental_quote_matches_full_quote():
+    text = "第一行\n第二行\n\n第四行"
+    for size in range(1, len(text) + 1):
+        pieces = [text[i:i + size] for i in range(0, len(text), size)]
+        quoted = "".join(incremental_quote(piece, i == 0) for i, piece in enumerate(pieces))
+        assert quoted == format_reasoning_as_quote(text)
+
+
+def test_split_analysis_sections():
+    content = f"{IMPACT_HEADING}\n\n利好内容\n\n{RISK_HEADING}\n\n风险内容\n"
+    assert split_analysis_sections(content) == ("利好内容", "风险内容")
+
+
+def test_split_analysis_sections_without_headings():
+    assert split_analysis_sections("影响有限") == ("影响有限", "")
+
+
+def test_reasoner_stream_splits_reasoning_and_sections():
+    content = f"{IMPACT_HEADING}\n利好\n{RISK_HEADING}\n风险"
+    # 风险提示标题被拆到多个片段中
+    pieces = [content[i:i + 3] for i in range(0, len(content), 3)]
+    chunks = [make_chunk(reasoning="想法\n"), make_chunk(reasoning="继续")]
+    chunks += [make_chunk(content=piece) for piece in pieces]
+    chunks.append(make_usage_chunk())
+    stream = ReasonerStream(FakeStream(chunks), threading.Event())
+
+    assert "".join(stream.reasoning()) == format_reasoning_as_quote("想法\n继续")
+    assert "".join(stream.content(until=RISK_HEADING)) == f"{IMPACT_HEADING}\n利好\n"
+    assert "".join(stream.content()) == f"{RISK_HEADING}\n风险"
+    assert "".join(stream.reasoning_parts) == "想法\n继续"
+    assert "".join(stream.content_parts) == content
+    assert stream.usage.prompt_cache_hit_tokens == 8
+
+
+def test_reasoner_stream_content_without_reasoning():
+    chunks = [make_chunk(content="答"), make_chunk(content="案")]
+    stream = ReasonerStream(FakeStream(chunks), threading.Event())
+
+    assert "".join(stream.reasoning()) == ""
+    assert "".join(stream.content()) == "答案"
+
+
+def test_reasoner_stream_stops_reading_when_event_set():
+    stop_event = threading.Event()
+    chunks = [make_chunk(content="第一段"), make_chunk(content="第二段")]
+    stream = ReasonerStream(FakeStream(chunks), stop_event)
+
+    content = stream.content()
+    stop_event.set()
+    assert "".join(content) == ""
+    assert stream.content_parts == []
+
+
+def test_reasoner_stream_close_closes_response():
+    response = FakeStream([make_chunk(content="答案")])
+    stream = ReasonerStream(response, threading.Event())
+    stream.close()
+    assert response.closed